@@ -2,23 +2,37 @@
 Implementation of storage manager for minio based storage
 """
 
+import atexit
 import datetime
 import logging
 import os
 import pathlib
+import time
 import concurrent.futures
-import typing
+import itertools
+from typing import Iterable
+from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import Tuple
 from collections import namedtuple
+from operator import attrgetter
 
+import certifi
 import minio
+import urllib3
 from minio.deleteobjects import DeleteObject
 
 from servicex_storage import object_storage_manager
 
 BucketInfo = namedtuple('BucketInfo', ['name', 'size', 'last_modified'])
 
+# identity for finding the oldest object, also used as the last modified time of empty buckets
+LATEST_TIME = datetime.datetime.max.replace(tzinfo=datetime.timezone.utc)
+
+# maximum number of keys S3 accepts in a single multi-object delete request
+DELETE_BATCH_SIZE = 1000
+
 
 class S3Store(object_storage_manager.ObjectStore):
   """
@@ -35,22 +49,55 @@ class S3Store(object_storage_manager.ObjectStore):
     self.access_key = access_key
     self.secret_key = secret_key
 
+    # set up threads to use, bucket scans are I/O bound so default to more threads than cpus
+    # but not so many that they contend for http connections
+    default_threads = min(16, 2 * (os.cpu_count() or 1))
+    if "THREADS" in os.environ:
+      try:
+        self.__threads = int(os.environ["THREADS"])
+        self.logger.debug("Using %d threads for storage cleanup", self.__threads)
+      except ValueError:
+        self.logger.exception("THREADS env variable not a number, using %d threads",
+                              default_threads)
+        self.__threads = default_threads
+    else:
+      self.__threads = default_threads
+
+    # minio's default connection pool keeps 10 connections per host, size it so every thread
+    # (and the parallel parts of multipart uploads) can hold a connection rather than
+    # serializing requests behind the pool, otherwise match minio's defaults
+    timeout = datetime.timedelta(minutes=5).seconds
+    http_client = urllib3.PoolManager(
+      timeout=urllib3.util.Timeout(connect=timeout, read=timeout),
+      maxsize=max(32, 2 * self.__threads),
+      cert_reqs='CERT_REQUIRED',
+      ca_certs=os.environ.get('SSL_CERT_FILE') or certifi.where(),
+      retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+    )
+
     # s3 client is thread safe using Threading, not so much with multiprocessing
     self.__s3_client = minio.Minio(self.s3_endpoint,
                                    access_key=self.access_key,
                                    secret_key=self.secret_key,
-                                   secure=use_https)
+                                   secure=use_https,
+                                   http_client=http_client)
 
-    # set up threads to use
-    if "THREADS" in os.environ:
+    # must use ThreadPool since minio client is thread safe with threading only,
+    # keep a single long lived pool so threads aren't respawned on every call
+    self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.__threads,
+                                                            thread_name_prefix='s3-io')
+    atexit.register(self.__executor.shutdown)
+
+    # cache bucket info so repeated usage checks don't rescan every object in every bucket
+    if "BUCKET_CACHE_TTL" in os.environ:
       try:
-        self.__threads = int(os.environ["THREADS"])
-        self.logger.debug("Using %d threads for storage cleanup", self.__threads)
+        self.__cache_ttl = float(os.environ["BUCKET_CACHE_TTL"])
       except ValueError:
-        self.logger.exception("THREADS env variable not a number, using a single thread")
-        self.__threads = 1
+        self.logger.exception("BUCKET_CACHE_TTL env variable not a number, using 60 seconds")
+        self.__cache_ttl = 60.0
     else:
-      self.__threads = 1
+      self.__cache_ttl = 60.0
+    self.__bucket_cache: Dict[str, Tuple[BucketInfo, float]] = {}
 
   def get_bucket_info(self, bucket: str) -> BucketInfo:
     """
@@ -58,16 +105,68 @@ class S3Store(object_storage_manager.ObjectStore):
     :param bucket: bucket name
     :return: None
     """
+    cached = self.__bucket_cache.get(bucket)
+    if cached is not None and time.monotonic() - cached[1] < self.__cache_ttl:
+      return cached[0]
 
-    objects = self.__s3_client.list_objects(bucket)
+    # listing already returns size and modification time, no need to stat each object
+    objects = self.__s3_client.list_objects(bucket, recursive=True)
     size = 0
-    last_modified = datetime.datetime.now(datetime.timezone.utc)
+    last_modified = LATEST_TIME
     for obj in objects:
-      result = self.__s3_client.stat_object(obj.bucket_name, obj.object_name)
-      size += result.size
-      if result.last_modified < last_modified:
-        last_modified = result.last_modified
-    return BucketInfo(name=bucket, size=size, last_modified=last_modified)
+      size += obj.size
+      if obj.last_modified < last_modified:
+        last_modified = obj.last_modified
+    bucket_info = BucketInfo(name=bucket, size=size, last_modified=last_modified)
+    self.__bucket_cache[bucket] = (bucket_info, time.monotonic())
+    return bucket_info
+
+  def __invalidate_bucket(self, bucket: str) -> None:
+    """
+    Remove cached info for a bucket after its contents change
+    :param bucket: bucket name
+    :return: None
+    """
+    self.__bucket_cache.pop(bucket, None)
+
+  def __prune_bucket_cache(self, buckets: List[str]) -> None:
+    """
+    Remove cached info for buckets that no longer exist, e.g. deleted by other processes
+    :param buckets: names of the buckets currently in the store
+    :return: None
+    """
+    current = set(buckets)
+    for bucket in list(self.__bucket_cache):
+      if bucket not in current:
+        self.__invalidate_bucket(bucket)
+
+  def __get_bucket_infos(self, buckets: Iterable[str],
+                         skip_errors: bool = False) -> Iterator[BucketInfo]:
+    """
+    Concurrently get bucket info for a set of buckets, keeping at most 2 * threads
+    requests outstanding and submitting a new one as each finishes
+    :param buckets: bucket names
+    :param skip_errors: log and skip buckets that can't be scanned instead of raising
+    :return: iterator of BucketInfo in order of completion
+    """
+    buckets = iter(buckets)
+    pending = {self.__executor.submit(self.get_bucket_info, x): x
+               for x in itertools.islice(buckets, self.__threads * 2)}
+    while pending:
+      done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+      finished = [(future, pending.pop(future)) for future in done]
+      # refill before handing results back so workers aren't idle while the caller runs
+      pending.update({self.__executor.submit(self.get_bucket_info, x): x
+                      for x in itertools.islice(buckets, len(done))})
+      for future, bucket in finished:
+        try:
+          bucket_info = future.result()
+        except Exception:  # pylint: disable=broad-except
+          if not skip_errors:
+            raise
+          self.logger.exception("Received exception while scanning %s, skipping it", bucket)
+          continue
+        yield bucket_info
 
   def delete_bucket(self, bucket: str) -> bool:
     """
@@ -75,16 +174,28 @@ class S3Store(object_storage_manager.ObjectStore):
     :param bucket: bucket name
     :return:  None
     """
-    if not self.__s3_client.bucket_exists(bucket):
+    self.__invalidate_bucket(bucket)
+    try:
+      if not self.__s3_client.bucket_exists(bucket):
+        return True
+      objects = iter(self.__s3_client.list_objects(bucket, recursive=True))
+      errors = []
+      while True:
+        batch = list(itertools.islice(objects, DELETE_BATCH_SIZE))
+        if not batch:
+          break
+        delete_objects = (DeleteObject(x.object_name) for x in batch)
+        # remove_objects is lazy, requests are only sent as the results are consumed
+        errors.extend(self.__s3_client.remove_objects(bucket, delete_objects))
+      if errors:
+        for error in errors:
+          self.logger.error("Error deleting %s from %s: %s", error.name, bucket, error.message)
+        return False
+      self.__s3_client.remove_bucket(bucket)
       return True
-    delete_objects = map(lambda x: DeleteObject(x.object_name), self.__s3_client.list_objects(bucket))
-    errors = 0
-    for error in self.__s3_client.remove_objects(bucket, delete_objects):
-      errors += 1
-    if errors != 0:
-      return False
-    self.__s3_client.remove_bucket(bucket)
-    return True
+    finally:
+      # a concurrent scan may have cached the bucket while it was being emptied
+      self.__invalidate_bucket(bucket)
 
   def get_storage_used(self) -> int:
     """
@@ -92,14 +203,12 @@ class S3Store(object_storage_manager.ObjectStore):
 
     :return: integer with number of bytes used
     """
-    buckets = self.__s3_client.list_buckets()
+    buckets = [x.name for x in self.__s3_client.list_buckets()]
+    self.__prune_bucket_cache(buckets)
     if len(buckets) == 0:
       return 0
 
-    # must use ThreadPool since minio client is thread safe with threading only
-    with concurrent.futures.ThreadPoolExecutor(max_workers=self.__threads) as executor:
-      sizes = executor.map(lambda x: self.get_bucket_info(x).size, buckets)
-    total_size = sum(sizes)
+    total_size = sum(x.size for x in self.__get_bucket_infos(buckets))
     return total_size
 
   def delete_object(self, bucket: str, object_name: str) -> None:
@@ -110,6 +219,7 @@ class S3Store(object_storage_manager.ObjectStore):
     :return: None
     """
     self.__s3_client.remove_object(bucket, object_name)
+    self.__invalidate_bucket(bucket)
 
   def delete_objects(self, bucket: str, object_names: List[str]) -> List[Tuple[str, str]]:
     """
@@ -120,7 +230,9 @@ class S3Store(object_storage_manager.ObjectStore):
     """
     delete_objects = [DeleteObject(x) for x in object_names]
     delete_results = self.__s3_client.remove_objects(bucket, delete_objects)
-    return [(x.name, x.message) for x in delete_results]
+    errors = [(x.name, x.message) for x in delete_results]
+    self.__invalidate_bucket(bucket)
+    return errors
 
   def get_file(self, bucket: str, object_name: str, path: pathlib.Path) -> None:
     """
@@ -130,13 +242,12 @@ class S3Store(object_storage_manager.ObjectStore):
     :param path: path to save
     :return: None
     """
+    # fget_object streams to a temporary file and releases the connection itself,
+    # it returns object stats rather than a response that needs closing
     try:
-      resp = self.__s3_client.fget_object(bucket, object_name, path)
+      self.__s3_client.fget_object(bucket, object_name, str(path))
     except Exception:  # pylint: disable=broad-except
       self.logger.exception("Got an exception while getting object")
-    finally:
-      resp.close()  # pylint: disable=no-member
-      resp.release_conn()  # pylint: disable=no-member
 
   def upload_file(self, bucket: str, object_name: str, path: pathlib.Path) -> None:
     """
@@ -151,6 +262,7 @@ class S3Store(object_storage_manager.ObjectStore):
       self.logger.error(mesg)
       raise IOError(mesg)
     self.__s3_client.fput_object(bucket, object_name, path)
+    self.__invalidate_bucket(bucket)
 
   def cleanup_storage(self, max_size: int, norm_size: int, max_age: int) -> Tuple[int, List[str]]:
     """
@@ -160,50 +272,69 @@ class S3Store(object_storage_manager.ObjectStore):
     :param max_age: max number of days a bucket can be before it is deleted
     :return: Tuple with final size of storage used and list of buckets removed
     """
-    buckets = map(lambda x: x.name, self.__s3_client.list_buckets())
+    buckets = list(map(attrgetter('name'), self.__s3_client.list_buckets()))
+    self.__prune_bucket_cache(buckets)
     cleaned_buckets = []
-    # must use ThreadPool since minio client is thread safe with threading only
-    with concurrent.futures.ThreadPoolExecutor(max_workers=self.__threads) as executor:
-      bucket_list = executor.map(self.get_bucket_info, buckets)
-
-    # concurrently delete any old buckets
-    with concurrent.futures.ThreadPoolExecutor(max_workers=self.__threads) as executor:
-      kept_buckets = []
-      old_buckets = []
-      for bucket in bucket_list:
-        bucket_age = (datetime.datetime.now(datetime.timezone.utc) - bucket.last_modified).days
-        if bucket_age > max_age:
-          old_buckets.append((bucket.name, bucket_age))
+
+    # as bucket info arrives, start deleting old buckets on the same pool so the deletions
+    # overlap the remaining scans, and total the size of the buckets that are kept.
+    # buckets that can't be scanned (e.g. removed since listing) are skipped so the scan
+    # never aborts while deletions are already in flight
+    now = datetime.datetime.now(datetime.timezone.utc)
+    current_size = 0
+    kept_buckets = []
+    futures = {}
+    for bucket in self.__get_bucket_infos(buckets, skip_errors=True):
+      bucket_age = (now - bucket.last_modified).days
+      if bucket_age > max_age:
+        future = self.__executor.submit(self.delete_bucket, bucket.name)
+        futures[future] = (bucket.name, bucket_age)
+      else:
+        current_size += bucket.size
+        kept_buckets.append(bucket)
+
+    for future in concurrent.futures.as_completed(futures):
+      bucket_info = futures[future]
+      try:
+        deleted = future.result()
+        # use mesg in both log outputs with different capitalizations of D
+        mesg = f"eleting {bucket_info[0]} due to age: {bucket_info[1]} days"
+        if deleted:
+          self.logger.info("D%s", mesg)
+          cleaned_buckets.append(bucket_info[0])
         else:
-          kept_buckets.append(bucket)
+          self.logger.error("Error d%s", mesg)
+      except Exception:  # pylint: disable=broad-except
+        self.logger.exception("Received exception while deleting %s due to age", bucket_info[0])
 
-      futures = {executor.submit(lambda x: self.delete_bucket(x), bucket[0]): (bucket[0], bucket[1])
-                 for bucket in old_buckets}
-      for future in concurrent.futures.as_completed(futures):
-        bucket_info = futures[future]
-        try:
-          deleted = future.result()
-          # use mesg in both log outputs with different capitalizations of D
-          mesg = f"eleting {bucket_info[0]} due to age: {bucket_info[1]} days"
-          if deleted:
-            self.logger.info("D%s", mesg)
-            cleaned_buckets.append(bucket_info[0])
-          else:
-            self.logger.error("Error d%s", mesg)
-        except Exception:  # pylint: disable=broad-except
-          self.logger.exception("Received exception while deleting %s due to age", bucket_info[0])
-
-    kept_buckets.sort(key=lambda x: x.last_modified)
-    idx = 0
-    current_size = sum(map(lambda x: x.size, kept_buckets))
-    if current_size > max_size:
-      while current_size > norm_size and idx < len(kept_buckets):
-        bucket = kept_buckets[idx]
-        self.logger.info("Deleting %s due to storage limits", bucket.name)
-        self.delete_bucket(bucket.name)
-        cleaned_buckets.append(bucket.name)
-        current_size -= bucket.size
-        idx += 1
+    # nothing else to remove, skip sorting the buckets
+    if current_size <= max_size:
+      return current_size, cleaned_buckets
+
+    kept_buckets.sort(key=attrgetter('last_modified'))
+    size_buckets = []
+    # iterate rather than index so the walk can never run past the end of the list
+    for bucket in kept_buckets:
+      if current_size <= norm_size:
+        break
+      size_buckets.append(bucket)
+      current_size -= bucket.size
+
+    # concurrently delete buckets needed to get below norm_size
+    futures = {self.__executor.submit(self.delete_bucket, bucket.name): bucket
+               for bucket in size_buckets}
+    for future in concurrent.futures.as_completed(futures):
+      bucket = futures[future]
+      try:
+        if future.result():
+          self.logger.info("Deleting %s due to storage limits", bucket.name)
+          cleaned_buckets.append(bucket.name)
+          continue
+        self.logger.error("Error deleting %s due to storage limits", bucket.name)
+      except Exception:  # pylint: disable=broad-except
+        self.logger.exception("Received exception while deleting %s due to storage limits",
+                              bucket.name)
+      current_size += bucket.size
     return current_size, cleaned_buckets
 
   def get_buckets(self) -> List[str]:
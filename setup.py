@@ -39,7 +39,9 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=[
+        'certifi',
         'minio',
+        'urllib3',
     ],
     extras_require={
         'test': [
@@ -1,4 +1,8 @@
 import datetime
+import os
+import pathlib
+import tempfile
+import threading
 import unittest
 from collections import namedtuple
 
@@ -7,26 +11,46 @@ from unittest.mock import patch
 import servicex_storage.s3_storage_manager
 
 ObjectInfo = namedtuple('ObjectInfo', ['size', 'last_modified'])
+ListedObject = namedtuple('ListedObject', ['bucket_name', 'object_name', 'size', 'last_modified'])
+Bucket = namedtuple('Bucket', ['name'])
+DeleteError = namedtuple('DeleteError', ['name', 'message'])
 s3_fake_objects = {
   "bucket1": {
     "object1": ObjectInfo(size=10,
-                          last_modified=datetime.datetime(year=2021, month=10, day=1, hour=10, minute=10, second=10)),
+                          last_modified=datetime.datetime(year=2021, month=10, day=1, hour=10, minute=10, second=10,
+                                                          tzinfo=datetime.timezone.utc)),
     "object2": ObjectInfo(size=20,
-                          last_modified=datetime.datetime(year=2021, month=10, day=1, hour=10, minute=11, second=10)),
+                          last_modified=datetime.datetime(year=2021, month=10, day=1, hour=10, minute=11, second=10,
+                                                          tzinfo=datetime.timezone.utc)),
     "object3": ObjectInfo(size=30,
-                          last_modified=datetime.datetime(year=2021, month=10, day=1, hour=10, minute=12, second=10)),
+                          last_modified=datetime.datetime(year=2021, month=10, day=1, hour=10, minute=12, second=10,
+                                                          tzinfo=datetime.timezone.utc)),
   },
   "bucket2": {
     "object4": ObjectInfo(size=100,
-                          last_modified=datetime.datetime(year=2020, month=10, day=1, hour=10, minute=10, second=10)),
+                          last_modified=datetime.datetime(year=2020, month=10, day=1, hour=10, minute=10, second=10,
+                                                          tzinfo=datetime.timezone.utc)),
     "object5": ObjectInfo(size=200,
-                          last_modified=datetime.datetime(year=2020, month=10, day=1, hour=10, minute=11, second=10)),
+                          last_modified=datetime.datetime(year=2020, month=10, day=1, hour=10, minute=11, second=10,
+                                                          tzinfo=datetime.timezone.utc)),
     "object6": ObjectInfo(size=300,
-                          last_modified=datetime.datetime(year=2020, month=10, day=1, hour=10, minute=12, second=10)),
+                          last_modified=datetime.datetime(year=2020, month=10, day=1, hour=10, minute=12, second=10,
+                                                          tzinfo=datetime.timezone.utc)),
   }
 }
 
 
+def list_objects(objects):
+  """
+  Build a list_objects side effect that returns listing entries from a fake object store
+  :param objects: dictionary of buckets to fake objects
+  :return: function suitable for use as a mock side effect
+  """
+  return lambda bucket, **kwargs: [ListedObject(bucket_name=bucket, object_name=name,
+                                                size=info.size, last_modified=info.last_modified)
+                                   for name, info in objects[bucket].items()]
+
+
 class MyTestCase(unittest.TestCase):
   @patch('minio.Minio')
   def test_s3_get_bucket_info(self, mock_class):
@@ -35,19 +59,59 @@ class MyTestCase(unittest.TestCase):
     :return: None
     """
 
-    mock_class().list_objects.return_value = list(s3_fake_objects["bucket1"].keys())
-    mock_class().stat_object.side_effect = list(s3_fake_objects["bucket1"].values())
+    mock_class().list_objects.side_effect = list_objects(s3_fake_objects)
     return_value = servicex_storage.s3_storage_manager.BucketInfo(name="bucket1",
                                                                   size=60,
                                                                   last_modified=datetime.datetime(
                                                                     year=2021, month=10,
                                                                     day=1, hour=10,
-                                                                    minute=10, second=10))
+                                                                    minute=10, second=10,
+                                                                    tzinfo=datetime.timezone.utc))
     test_obj = servicex_storage.s3_storage_manager.S3Store(s3_endpoint="abc",
                                                            access_key="abc",
                                                            secret_key="abc")
     bucket_info = test_obj.get_bucket_info("bucket1")
     self.assertEqual(bucket_info, return_value)
+    mock_class().list_objects.assert_called_with("bucket1", recursive=True)
+    mock_class().stat_object.assert_not_called()
+
+  @patch('minio.Minio')
+  def test_s3_get_bucket_info_empty(self, mock_class):
+    """
+    Test s3's get bucket info on a bucket without objects
+    :return: None
+    """
+    mock_class().list_objects.return_value = []
+    test_obj = servicex_storage.s3_storage_manager.S3Store(s3_endpoint="abc",
+                                                           access_key="abc",
+                                                           secret_key="abc")
+    bucket_info = test_obj.get_bucket_info("bucket1")
+    self.assertEqual(bucket_info.size, 0)
+    self.assertEqual(bucket_info.last_modified, servicex_storage.s3_storage_manager.LATEST_TIME)
+
+  @patch('minio.Minio')
+  def test_s3_get_bucket_info_cached(self, mock_class):
+    """
+    Test that s3's bucket info is cached until the bucket changes
+    :return: None
+    """
+    mock_class().list_objects.side_effect = list_objects(s3_fake_objects)
+    test_obj = servicex_storage.s3_storage_manager.S3Store(s3_endpoint="abc",
+                                                           access_key="abc",
+                                                           secret_key="abc")
+    first_info = test_obj.get_bucket_info("bucket1")
+    self.assertEqual(test_obj.get_bucket_info("bucket1"), first_info)
+    self.assertEqual(mock_class().list_objects.call_count, 1)
+
+    test_obj.delete_object("bucket1", "object1")
+    test_obj.get_bucket_info("bucket1")
+    self.assertEqual(mock_class().list_objects.call_count, 2)
+
+    # buckets removed outside of this store are dropped from the cache
+    mock_class().list_buckets.return_value = [Bucket(name="bucket2")]
+    test_obj.get_storage_used()
+    test_obj.get_bucket_info("bucket1")
+    self.assertEqual(mock_class().list_objects.call_count, 4)
 
   @patch('minio.Minio')
   def test_minio_get_storage_used(self, mock_class):
@@ -55,11 +119,8 @@ class MyTestCase(unittest.TestCase):
     Test getting storage used by a s3 bucket
     :return: None
     """
-    mock_class().list_buckets.return_value = list(s3_fake_objects.keys())
-    mock_class().list_objects.side_effect = [list(s3_fake_objects["bucket1"].keys()),
-                                             list(s3_fake_objects["bucket2"].keys())]
-    mock_class().stat_object.side_effect = list(s3_fake_objects["bucket1"].values()) + \
-                                           list(s3_fake_objects["bucket2"].values())
+    mock_class().list_buckets.return_value = [Bucket(name=x) for x in s3_fake_objects]
+    mock_class().list_objects.side_effect = list_objects(s3_fake_objects)
 
     test_obj = servicex_storage.s3_storage_manager.S3Store(s3_endpoint="abc",
                                                            access_key="abc",
@@ -77,31 +138,27 @@ class MyTestCase(unittest.TestCase):
     current_s3_fake_objects = {
       "bucket1": {
         "object1": ObjectInfo(size=10,
-                              last_modified=datetime.datetime.utcnow()),
+                              last_modified=datetime.datetime.now(datetime.timezone.utc)),
         "object2": ObjectInfo(size=20,
-                              last_modified=datetime.datetime.utcnow()),
+                              last_modified=datetime.datetime.now(datetime.timezone.utc)),
         "object3": ObjectInfo(size=30,
-                              last_modified=datetime.datetime.utcnow()),
+                              last_modified=datetime.datetime.now(datetime.timezone.utc)),
       },
       "bucket2": {
         "object4": ObjectInfo(size=100,
                               last_modified=datetime.datetime(year=2020, month=10, day=1, hour=10, minute=10,
-                                                              second=10)),
+                                                              second=10, tzinfo=datetime.timezone.utc)),
         "object5": ObjectInfo(size=200,
                               last_modified=datetime.datetime(year=2020, month=10, day=1, hour=10, minute=11,
-                                                              second=10)),
+                                                              second=10, tzinfo=datetime.timezone.utc)),
         "object6": ObjectInfo(size=300,
                               last_modified=datetime.datetime(year=2020, month=10, day=1, hour=10, minute=12,
-                                                              second=10)),
+                                                              second=10, tzinfo=datetime.timezone.utc)),
       }
     }
 
-    mock_class().list_buckets.return_value = list(current_s3_fake_objects.keys())
-    mock_class().list_objects.side_effect = [list(current_s3_fake_objects["bucket1"].keys()),
-                                             list(current_s3_fake_objects["bucket2"].keys()),
-                                             list(current_s3_fake_objects["bucket2"].keys())]
-    mock_class().stat_object.side_effect = list(current_s3_fake_objects["bucket1"].values()) + \
-                                           list(current_s3_fake_objects["bucket2"].values())
+    mock_class().list_buckets.return_value = [Bucket(name=x) for x in current_s3_fake_objects]
+    mock_class().list_objects.side_effect = list_objects(current_s3_fake_objects)
 
     test_obj = servicex_storage.s3_storage_manager.S3Store(s3_endpoint="abc",
                                                            access_key="abc",
@@ -109,7 +166,165 @@ class MyTestCase(unittest.TestCase):
 
     final_size = test_obj.cleanup_storage(70, 60, 365)[0]
     self.assertEqual(final_size, 60)
-    mock_class().remove_objects.assert_called_with("bucket2", ["object4", "object5", "object6"])
+    bucket, delete_objects = mock_class().remove_objects.call_args[0]
+    self.assertEqual(bucket, "bucket2")
+    self.assertEqual([x._name for x in delete_objects], ["object4", "object5", "object6"])
+
+  @patch('minio.Minio')
+  def test_s3_get_storage_used_refills(self, mock_class):
+    """
+    Test that a slow bucket doesn't stop other buckets from being scanned
+    :return: None
+    """
+    fast_buckets = [f"bucket{x}" for x in range(5)]
+    scanned = []
+    released = threading.Event()
+
+    def slow_list_objects(bucket, **kwargs):
+      if bucket == "slow":
+        self.assertTrue(released.wait(5))
+      else:
+        scanned.append(bucket)
+        if len(scanned) == len(fast_buckets):
+          released.set()
+      return []
+
+    mock_class().list_buckets.return_value = [Bucket(name=x) for x in ["slow"] + fast_buckets]
+    mock_class().list_objects.side_effect = slow_list_objects
+    with patch.dict(os.environ, {"THREADS": "2"}):
+      test_obj = servicex_storage.s3_storage_manager.S3Store(s3_endpoint="abc",
+                                                             access_key="abc",
+                                                             secret_key="abc")
+    self.assertEqual(test_obj.get_storage_used(), 0)
+    self.assertTrue(released.is_set())
+
+  @patch('minio.Minio')
+  def test_s3_cleanup_storage_under_limit(self, mock_class):
+    """
+    Test that s3's cleanup doesn't delete anything when storage is under the limit
+    :return: None
+    """
+    mock_class().list_buckets.return_value = [Bucket(name=x) for x in s3_fake_objects]
+    mock_class().list_objects.side_effect = list_objects(s3_fake_objects)
+    test_obj = servicex_storage.s3_storage_manager.S3Store(s3_endpoint="abc",
+                                                           access_key="abc",
+                                                           secret_key="abc")
+    self.assertEqual(test_obj.cleanup_storage(1000, 500, 100000), (660, []))
+    mock_class().remove_bucket.assert_not_called()
+
+  @patch('minio.Minio')
+  def test_s3_cleanup_storage_scan_error(self, mock_class):
+    """
+    Test that s3's cleanup skips buckets that can't be scanned and still reports deletions
+    :return: None
+    """
+    mock_class().list_buckets.return_value = [Bucket(name=x)
+                                              for x in ["missing"] + list(s3_fake_objects)]
+    # list_objects raises KeyError for the missing bucket
+    mock_class().list_objects.side_effect = list_objects(s3_fake_objects)
+    mock_class().remove_objects.return_value = []
+    with patch.dict(os.environ, {"THREADS": "2"}):
+      test_obj = servicex_storage.s3_storage_manager.S3Store(s3_endpoint="abc",
+                                                             access_key="abc",
+                                                             secret_key="abc")
+    final_size, cleaned_buckets = test_obj.cleanup_storage(1000, 500, 365)
+    self.assertEqual(final_size, 0)
+    self.assertEqual(sorted(cleaned_buckets), ["bucket1", "bucket2"])
+    removed = sorted(x[0][0] for x in mock_class().remove_bucket.call_args_list)
+    self.assertEqual(removed, ["bucket1", "bucket2"])
+
+  @patch('minio.Minio')
+  def test_s3_cleanup_storage_all_buckets(self, mock_class):
+    """
+    Test that s3's cleanup stops after deleting every bucket if norm_size can't be reached
+    :return: None
+    """
+    mock_class().list_buckets.return_value = [Bucket(name=x) for x in s3_fake_objects]
+    mock_class().list_objects.side_effect = list_objects(s3_fake_objects)
+    mock_class().remove_objects.return_value = []
+    test_obj = servicex_storage.s3_storage_manager.S3Store(s3_endpoint="abc",
+                                                           access_key="abc",
+                                                           secret_key="abc")
+    final_size, cleaned_buckets = test_obj.cleanup_storage(10, -1, 100000)
+    self.assertEqual(final_size, 0)
+    self.assertEqual(sorted(cleaned_buckets), ["bucket1", "bucket2"])
+
+  @patch('minio.Minio')
+  def test_s3_delete_bucket_batches(self, mock_class):
+    """
+    Test that s3's delete bucket removes objects in batches of at most 1000
+    :return: None
+    """
+    mock_class().list_objects.return_value = [ListedObject(bucket_name="bucket1",
+                                                           object_name=f"object{x}",
+                                                           size=1, last_modified=None)
+                                              for x in range(2500)]
+    batch_sizes = []
+
+    def remove_objects(bucket, objects):
+      batch_sizes.append(len(list(objects)))
+      return []
+
+    mock_class().remove_objects.side_effect = remove_objects
+    test_obj = servicex_storage.s3_storage_manager.S3Store(s3_endpoint="abc",
+                                                           access_key="abc",
+                                                           secret_key="abc")
+    self.assertTrue(test_obj.delete_bucket("bucket1"))
+    self.assertEqual(batch_sizes, [1000, 1000, 500])
+    mock_class().remove_bucket.assert_called_once_with("bucket1")
+
+  @patch('minio.Minio')
+  def test_s3_delete_bucket_errors(self, mock_class):
+    """
+    Test that s3's delete bucket keeps the bucket if objects can't be removed
+    :return: None
+    """
+    mock_class().list_objects.side_effect = list_objects(s3_fake_objects)
+    mock_class().remove_objects.return_value = [DeleteError(name="object1", message="denied")]
+    test_obj = servicex_storage.s3_storage_manager.S3Store(s3_endpoint="abc",
+                                                           access_key="abc",
+                                                           secret_key="abc")
+    self.assertFalse(test_obj.delete_bucket("bucket1"))
+    mock_class().remove_bucket.assert_not_called()
+
+  @patch('minio.Minio')
+  def test_s3_get_file(self, mock_class):
+    """
+    Test that s3's get file downloads to the given path
+    :return: None
+    """
+    test_obj = servicex_storage.s3_storage_manager.S3Store(s3_endpoint="abc",
+                                                           access_key="abc",
+                                                           secret_key="abc")
+    test_obj.get_file("bucket1", "object1", pathlib.Path("/tmp/object1"))
+    mock_class().fget_object.assert_called_once_with("bucket1", "object1", "/tmp/object1")
+
+  @patch('minio.Minio')
+  def test_s3_upload_file(self, mock_class):
+    """
+    Test that s3's upload file uploads the given path
+    :return: None
+    """
+    test_obj = servicex_storage.s3_storage_manager.S3Store(s3_endpoint="abc",
+                                                           access_key="abc",
+                                                           secret_key="abc")
+    with tempfile.NamedTemporaryFile() as source:
+      test_obj.upload_file("bucket1", "object1", pathlib.Path(source.name))
+      mock_class().fput_object.assert_called_once_with("bucket1", "object1",
+                                                       pathlib.Path(source.name))
+
+  @patch('minio.Minio')
+  def test_s3_connection_pool_size(self, mock_class):
+    """
+    Test that the http connection pool is large enough for all threads
+    :return: None
+    """
+    with patch.dict(os.environ, {"THREADS": "24"}):
+      servicex_storage.s3_storage_manager.S3Store(s3_endpoint="abc",
+                                                  access_key="abc",
+                                                  secret_key="abc")
+    http_client = mock_class.call_args[1]["http_client"]
+    self.assertEqual(http_client.connection_pool_kw["maxsize"], 48)
 
 
 if __name__ == '__main__':